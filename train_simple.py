@@ -195,6 +195,9 @@ def main(
     eval_every: int = 1000000,
     sync_command: Optional[str] = None,
     strong_ckpt_path: Optional[str] = None,  ## added from Dang's code
+
+    # Where to cache tokenized datasets across runs; set to "" to disable.
+    tokenized_cache_dir: Optional[str] = None,
 ):
     
     #### INITIALIZATION ####
@@ -314,13 +317,16 @@ def main(
         config_name=config_name,
     )
 
-    # Tokenize datasets
+    # Tokenize datasets, caching the tokenized copies on disk across runs
+    if tokenized_cache_dir is None:
+        tokenized_cache_dir = os.path.join(results_folder, "tokenized")
+    tokenized_cache_dir = tokenized_cache_dir or None
     tokenizer = get_tokenizer(model_config.name)
     print("Max context: {}.format(max_ctx)")
-    train1_ds = tokenize_dataset(train1_ds, tokenizer, max_ctx)
-    test_ds = tokenize_dataset(test_ds, tokenizer, max_ctx)
+    train1_ds = tokenize_dataset(train1_ds, tokenizer, max_ctx, cache_dir=tokenized_cache_dir)
+    test_ds = tokenize_dataset(test_ds, tokenizer, max_ctx, cache_dir=tokenized_cache_dir)
     if train2_ds:
-        train2_ds = tokenize_dataset(train2_ds, tokenizer, max_ctx)
+        train2_ds = tokenize_dataset(train2_ds, tokenizer, max_ctx, cache_dir=tokenized_cache_dir)
 
     #### TRAINING, EVAL, AND SAVE ####
 
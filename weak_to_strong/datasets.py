@@ -1,10 +1,13 @@
-import functools
+import os
 from dataclasses import dataclass
 from random import Random
 from typing import Any, Callable, Optional
 
+import numpy as np
+
 from datasets import Dataset as HfDataset
 from datasets import load_dataset as hf_load_dataset
+from datasets import load_from_disk
 
 
 @dataclass
@@ -30,6 +33,27 @@ def load_dataset(ds_name: str, seed: int = 0, split_sizes: Optional[dict] = None
     if ds_name not in _REGISTRY:
         raise ValueError(f"Unknown dataset {ds_name}, please register")
     cfg = _REGISTRY[ds_name]
+
+    # format + soft_label in a single batched pass over the Arrow table, instead of
+    # two sequential maps that each re-serialize every column
+    def combined(batch, indices, seed):
+        keys = list(batch.keys())
+        out = {"txt": [], "hard_label": [], "soft_label": []}
+        for i, idx in enumerate(indices):
+            ex = {k: batch[k][i] for k in keys}
+            # each row gets its own rng seeded from (seed, row index), so the
+            # labels don't depend on batch or shard layout and workers can
+            # process rows in any order. hash() because random.seed only takes
+            # ints since 3.11; int-tuple hashes don't vary with PYTHONHASHSEED
+            formatted = cfg.formatter(ex, rng=Random(hash((seed, idx))))
+            out["txt"].append(formatted["txt"])
+            out["hard_label"].append(formatted["hard_label"])
+        # emit soft labels as one fixed-shape float32 array so Arrow stores a
+        # (N, 2) numeric column that torch can view without per-row conversion
+        hards = np.asarray(out["hard_label"], dtype=np.float32)
+        out["soft_label"] = np.stack([1 - hards, hards], axis=1)
+        return out
+
     results = {}
     for split, n_docs in split_sizes.items():
         ds = cfg.loader(split)
@@ -37,9 +61,14 @@ def load_dataset(ds_name: str, seed: int = 0, split_sizes: Optional[dict] = None
             ds = ds.select(range(n_docs))
         except IndexError as e:
             print(f"Warning {ds_name} has less than {n_docs} docs, using all: {e}")
-        ds = ds.map(functools.partial(cfg.formatter, rng=Random(seed)))
         ds = ds.map(
-            lambda ex: {"soft_label": [1 - float(ex["hard_label"]), float(ex["hard_label"])]}
+            combined,
+            batched=True,
+            batch_size=1000,
+            with_indices=True,
+            fn_kwargs={"seed": seed},
+            remove_columns=ds.column_names,
+            num_proc=min(os.cpu_count() or 1, 8),
         )
         ds = ds.shuffle(seed=seed)  # shuffling a bit pointless for test set but wtv
         results[split] = ds
@@ -50,6 +79,7 @@ def tokenize_dataset(
     raw_ds: HfDataset,
     tokenizer: Callable,
     max_ctx: int,
+    cache_dir: Optional[str] = None,
 ):
     """
     This function prepares the dataset for training. It takes the raw dataset, a formatting function,
@@ -59,18 +89,37 @@ def tokenize_dataset(
     raw_ds: The raw dataset to be processed.
     tokenizer: The tokenizer to be used on the formatted dataset.
     max_ctx: The maximum context length for the tokenizer.
+    cache_dir: If set, the tokenized dataset is saved here (keyed on the raw
+        dataset fingerprint, tokenizer and max_ctx) and reloaded on later runs.
 
     Returns:
     ds: The processed and shuffled dataset ready for training.
     """
 
+    if cache_dir is not None:
+        tok_name = str(getattr(tokenizer, "name_or_path", "tokenizer")).replace("/", "_")
+        cache_path = os.path.join(cache_dir, f"{raw_ds._fingerprint}_{tok_name}_{max_ctx}")
+        if os.path.exists(cache_path):
+            print("loading tokenized dataset from", cache_path)
+            return load_from_disk(cache_path)
+
     def process_function(res):
+        # batched map: res["txt"] is a list of strings, so fast (Rust) tokenizers
+        # process the whole batch in one native call instead of one FFI call per row
         toks = tokenizer(res["txt"])
         return dict(
             input_ids=toks["input_ids"],
         )
 
-    ds = raw_ds.map(process_function, batched=False).filter(lambda x: len(x["input_ids"]) < max_ctx)
+    ds = raw_ds.map(process_function, batched=True, batch_size=1000).filter(
+        lambda x: [len(ids) < max_ctx for ids in x["input_ids"]], batched=True
+    )
+    # hand back torch views of the Arrow buffers so the training loop doesn't
+    # rebuild tensors from Python lists on every step
+    ds.set_format(type="torch", columns=["input_ids", "soft_label"], output_all_columns=True)
+    if cache_dir is not None:
+        ds.save_to_disk(cache_path)
+        print("saved tokenized dataset to", cache_path)
     return ds
 
 
@@ -14,56 +14,84 @@ def unpack(x):
     return x.detach().float().cpu().numpy().tolist()
 
 
-def eval_model_acc(model: nn.Module, ds: datasets.Dataset, eval_batch_size: int = 16) -> None:
+def eval_model_acc(
+    model: nn.Module,
+    ds: datasets.Dataset,
+    eval_batch_size: int = 16,
+    mixed_precision: str = "bf16",
+) -> None:
     """
     This function evaluates the accuracy of a given model on a given dataset.
 
     Parameters:
     model (nn.Module): The model to be evaluated.
     ds (datasets.Dataset): The dataset on which the model is to be evaluated.
+    mixed_precision (str): Autocast dtype for the forward pass (bf16, fp16 or
+                           none), normally the same setting training used.
 
     Returns:
     results (list): A list of dictionaries containing the input_ids, ground truth label, predicted label,
                     accuracy of prediction, logits and soft label for each example in the dataset.
     """
 
+    if ds is None:
+        return None
+
+    # remember the caller's mode so training with dropout isn't silently
+    # left in eval mode after an intermediate eval
+    was_training = model.training
     model.eval()
+    io_device = model.device if hasattr(model, "device") else "cpu"
+    autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "none": None}[
+        mixed_precision
+    ]
+    use_autocast = (
+        autocast_dtype is not None
+        and torch.cuda.is_available()
+        and (autocast_dtype is not torch.bfloat16 or torch.cuda.is_bf16_supported())
+    )
 
-    with torch.no_grad():
-        results = []
-        # for ex in ds:
+    with torch.inference_mode():
+        all_logits = []
         for batch in to_batch(ds, eval_batch_size):
             # pad input_ids to common length
             input_ids = torch.nn.utils.rnn.pad_sequence(
-                [torch.tensor(ex) for ex in batch["input_ids"]], batch_first=True
-            ).to(model.device if hasattr(model, "device") else "cpu")
-            labels = batch["soft_label"]
+                list(batch["input_ids"]), batch_first=True
+            ).to(io_device)
             # run forward pass
-            raw_logits = model(input_ids)
+            with torch.autocast(
+                device_type="cuda",
+                dtype=autocast_dtype or torch.bfloat16,
+                enabled=use_autocast,
+            ):
+                raw_logits = model(input_ids)
+            # keep logits on device; a single transfer at the end avoids one
+            # device->host sync per batch
+            all_logits.append(raw_logits)
 
-            probs = unpack(torch.nn.functional.softmax(raw_logits, dim=-1))
-            logits = unpack(raw_logits)
+        raw_logits = torch.cat(all_logits).float()
+        probs = unpack(torch.nn.functional.softmax(raw_logits, dim=-1))
+        logits = unpack(raw_logits)
 
-            preds = np.argmax(probs, axis=-1)
-            labels = np.argmax(labels, axis=-1)
+        preds = np.argmax(probs, axis=-1)
+        labels = np.argmax(ds["soft_label"], axis=-1)
 
-            results.extend(
-                [
-                    dict(
-                        txt=txt,
-                        input_ids=input_id,
-                        gt_label=label,
-                        hard_label=pred,
-                        acc=label == pred,
-                        logits=logit,
-                        soft_label=prob,
-                    )
-                    for input_id, txt, label, pred, prob, logit in zip(
-                        batch["input_ids"], batch["txt"], labels, preds, probs, logits
-                    )
-                ]
+        results = [
+            dict(
+                txt=txt,
+                input_ids=input_id,
+                gt_label=label,
+                hard_label=pred,
+                acc=label == pred,
+                logits=logit,
+                soft_label=prob,
+            )
+            for input_id, txt, label, pred, prob, logit in zip(
+                ds["input_ids"], ds["txt"], labels, preds, probs, logits
             )
+        ]
         accs = [r["acc"] for r in results]
         print("Accuracy:", np.mean(accs), "+/-", np.std(accs) / np.sqrt(len(accs)))
 
-        return datasets.Dataset.from_list(results)
+    model.train(was_training)
+    return datasets.Dataset.from_list(results)
@@ -59,5 +59,7 @@ class TransformerWithHead(PreTrainedModel):
         self.score.to(hidden_states.device)
         if self.linear_probe:
             hidden_states = hidden_states.detach()
-        logits = self.score(hidden_states)
+        # the backbone may run in a lower precision than the head (e.g. a
+        # bf16/int8 quantized transformer with an fp32 probe)
+        logits = self.score(hidden_states.to(self.score.weight.dtype))
         return logits
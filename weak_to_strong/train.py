@@ -1,5 +1,6 @@
 import itertools
 import os
+import random
 import time
 from dataclasses import dataclass
 from typing import Callable, Optional
@@ -9,6 +10,7 @@ import numpy as np
 import torch
 import torch_optimizer as toptim
 from transformers.modeling_utils import load_sharded_checkpoint
+from transformers.pytorch_utils import Conv1D
 from safetensors.torch import load_model
 
 import weak_to_strong.logger as logger
@@ -17,6 +19,56 @@ from weak_to_strong.eval import eval_model_acc
 from weak_to_strong.loss import xent_loss
 from weak_to_strong.model import TransformerWithHead
 
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+    Yields minibatches of indices whose sequences have similar lengths, so
+    pad_collate pads far fewer wasted tokens than fully random batching would.
+
+    Indices are sorted by length and chunked into buckets of
+    batch_size * bucket_mult; each epoch both the order within each bucket and
+    the order of the resulting batches are reshuffled, so batch order stays
+    random while batch contents stay length-homogeneous.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_mult=50, seed=0):
+        self.sorted_indices = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_mult
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        batches = []
+        for start in range(0, len(self.sorted_indices), self.bucket_size):
+            bucket = self.sorted_indices[start : start + self.bucket_size]
+            self.rng.shuffle(bucket)
+            batches.extend(
+                bucket[i : i + self.batch_size]
+                for i in range(0, len(bucket), self.batch_size)
+            )
+        self.rng.shuffle(batches)
+        yield from batches
+
+    def __len__(self):
+        return (len(self.sorted_indices) + self.batch_size - 1) // self.batch_size
+
+
+def pad_collate(batch):
+    """
+    Collate a list of examples (with torch-formatted "input_ids" and "soft_label")
+    into a padded input_ids tensor and a stacked soft_label tensor.
+    """
+    seqs = [ex["input_ids"] for ex in batch]
+    lengths = [len(s) for s in seqs]
+    # allocate the padded output once and copy rows in, rather than letting
+    # pad_sequence do per-sequence bookkeeping; zero-padding is what the model
+    # expects, since it infers sequence lengths from the non-zero token ids
+    input_ids = torch.zeros(len(seqs), max(lengths), dtype=torch.long)
+    for i, seq in enumerate(seqs):
+        input_ids[i, : lengths[i]] = seq
+    soft_labels = torch.stack([ex["soft_label"] for ex in batch])
+    return {"input_ids": input_ids, "soft_label": soft_labels}
+
+
 @dataclass
 class ModelConfig:
     name: str
@@ -44,9 +96,16 @@ def train_model(
     epochs: int = 1,
     lr_schedule: str = "cosine_anneal",
     optimizer_name: str = "adam",
+    mixed_precision: str = "bf16",
+    compile_model: bool = True,
 ):
     print("LR", lr, "batch_size", batch_size, "minibatch_size", minibatch_size)
     assert batch_size % minibatch_size == 0, "batch size must be divisible by minibatch size"
+    assert mixed_precision in (
+        "bf16",
+        "fp16",
+        "none",
+    ), f"invalid mixed_precision {mixed_precision}, must be bf16, fp16 or none"
     
     # we purposefully turn off dropout, for determinism
     # this seems to help for 1 epoch finetuning anyways
@@ -59,6 +118,19 @@ def train_model(
             model if hasattr(model, "gradient_checkpointing_enable") else model.module
         ).gradient_checkpointing_enable()
 
+    # compile here, after any checkpoints have been loaded into the raw module;
+    # the length buckets keep shapes mostly stable within a bucket, and
+    # dynamic=True absorbs the residual cross-bucket length variation.
+    # DataParallel wrappers are skipped: TorchDynamo doesn't support tracing
+    # through DataParallel's scatter/gather
+    if (
+        compile_model
+        and torch.cuda.is_available()
+        and hasattr(torch, "compile")
+        and not isinstance(model, torch.nn.DataParallel)
+    ):
+        model = torch.compile(model, mode="reduce-overhead", dynamic=True)
+
     nsteps = len(ds) * epochs // batch_size
 
     def lr_schedule_fn(step):
@@ -77,10 +149,46 @@ def train_model(
         lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, nsteps)
     else:
         lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_schedule_fn)
+    autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "none": None}[
+        mixed_precision
+    ]
+    if (
+        autocast_dtype is torch.bfloat16
+        and torch.cuda.is_available()
+        and not torch.cuda.is_bf16_supported()
+    ):
+        # pre-Ampere GPUs (e.g. V100) reject bf16 autocast outright
+        print("bf16 autocast not supported on this GPU, falling back to fp16")
+        autocast_dtype = torch.float16
+    use_autocast = autocast_dtype is not None and torch.cuda.is_available()
+    if use_autocast and isinstance(model, torch.nn.DataParallel):
+        # autocast state is thread-local: DataParallel's worker threads re-enter
+        # autocast with only the enabled flag and the default fp16 dtype, so a
+        # bf16 request would silently run the replicas in unscaled fp16. Keep
+        # replicas in full precision instead (as with the torch.compile skip)
+        print("autocast does not propagate through DataParallel replicas, disabling it")
+        use_autocast = False
+    # only fp16 needs loss scaling; for bf16/fp32 the scaler passes through unchanged
+    scaler = torch.cuda.amp.GradScaler(
+        enabled=(use_autocast and autocast_dtype is torch.float16)
+    )
+
     step = 0
-    it = itertools.chain.from_iterable(itertools.repeat(ds, epochs))
+    accum_steps = batch_size // minibatch_size
+    # workers prepare + pin the next minibatches while the GPU is busy with this one
+    bucket_sampler = LengthBucketSampler(
+        [len(x) for x in ds["input_ids"]], minibatch_size
+    )
+    loader = torch.utils.data.DataLoader(
+        ds,
+        batch_sampler=bucket_sampler,
+        collate_fn=pad_collate,
+        num_workers=4,
+        pin_memory=True,
+        persistent_workers=True,
+    )
+    it = itertools.chain.from_iterable(itertools.repeat(loader, epochs))
     losses = []
-    accuracies = []
     eval_acc_dict = {}
 
     # If the model is wrapped by DataParallel, it doesn't have a device. In this case,
@@ -88,77 +196,79 @@ def train_model(
     # a bit more data than other ones, but hopefully should not be too big of a deal.
     io_device = model.device if hasattr(model, "device") else 0
 
+    # device-side accuracy counter, drained with one .item() per logging
+    # interval instead of syncing the host every step
+    correct_buf = torch.zeros((), device=io_device, dtype=torch.long)
+    seen_tot = 0
+
     while step < nsteps:
         loss_tot = 0
-        if eval_every and (step + 1) % eval_every == 0:
-            eval_results = eval_model_acc(model, eval_ds, eval_batch_size)
-            if gradient_checkpointing:
-                (
-                    model if hasattr(model, "gradient_checkpointing_enable") else model.module
-                ).gradient_checkpointing_enable()
-            if train_with_dropout:
-                model.train()
+        if eval_every and eval_ds is not None and (step + 1) % eval_every == 0:
+            # eval_model_acc restores the model's train/eval mode itself
+            eval_results = eval_model_acc(
+                model, eval_ds, eval_batch_size, mixed_precision=mixed_precision
+            )
             eval_accs = np.mean([r["acc"] for r in eval_results])
             eval_acc_dict[step] = eval_accs
             logger.logkv("eval_accuracy", eval_accs)
-        all_logits = []
-        all_labels = []
-        for i in range(batch_size // minibatch_size):
+        # free grads rather than memset them; backward re-materializes them
+        optimizer.zero_grad(set_to_none=True)
+        for i in range(accum_steps):
             try:
-                mbatch = [next(it) for _ in range(minibatch_size)]
+                mbatch = next(it)
             except StopIteration:
                 break
-            input_ids = (
-                torch.nn.utils.rnn.pad_sequence([torch.tensor(ex["input_ids"]) for ex in mbatch])
-                .transpose(
-                    0,
-                    1,
-                )
-                .to(io_device)
-            )
-            labels = torch.tensor([ex["soft_label"] for ex in mbatch]).to(io_device)
+            input_ids = mbatch["input_ids"].to(io_device, non_blocking=True)
+            labels = mbatch["soft_label"].to(io_device, non_blocking=True)
 
-            logits = model(input_ids)
+            with torch.autocast(
+                device_type="cuda",
+                dtype=autocast_dtype or torch.bfloat16,
+                enabled=use_autocast,
+            ):
+                logits = model(input_ids)
 
-            all_logits.extend(logits.to(io_device))
-            all_labels.extend(labels)
-        all_logits = torch.stack(all_logits)
-        all_labels = torch.stack(all_labels)
-        loss = loss_fn(all_logits, all_labels, step_frac=step / nsteps)
-        loss_tot += loss.item()
-        loss.backward()
+                # backward per minibatch so only one minibatch's activations are
+                # ever live; gradients accumulate across the effective batch
+                loss = loss_fn(logits, labels, step_frac=step / nsteps) / accum_steps
+            loss_tot += loss.item()
+            scaler.scale(loss).backward()
+
+            # count matches instead of keeping every minibatch's logits around;
+            # the sum stays on device until the next logging interval
+            preds = torch.argmax(logits.detach(), dim=1)
+            targets = torch.argmax(labels, dim=1)
+            correct_buf += (preds == targets).sum()
+            seen_tot += targets.size(0)
         losses.append(loss_tot)
-        accuracies.append(
-            torch.mean(
-                (torch.argmax(all_logits, dim=1) == torch.argmax(all_labels, dim=1)).to(
-                    torch.float32
-                )
-            ).item()
-        )
         logger.logkvs(
             {
                 "step": step,
                 "progress": step / nsteps,
                 "loss": loss_tot,
-                "train_accuracy": accuracies[-1],
                 "lr": lr_scheduler.get_last_lr()[0],
             }
         )
-        optimizer.step()
-        optimizer.zero_grad()
+        scaler.step(optimizer)
+        scaler.update()
         lr_scheduler.step()
         if log_every and step % log_every == 0:
+            train_acc = correct_buf.item() / max(seen_tot, 1)
+            correct_buf.zero_()
+            seen_tot = 0
+            logger.logkv("train_accuracy", train_acc)
             print(
-                f"Step: {step}/{nsteps} Recent losses: {np.mean(losses)} {np.mean(accuracies)} {len(losses)}"
+                f"Step: {step}/{nsteps} Recent losses: {np.mean(losses)} {train_acc} {len(losses)}"
             )
             losses = []
-            accuracies = []
         step += 1
         logger.dumpkvs()
     final_eval_results = None
-    if eval_every:
+    if eval_every and eval_ds is not None:
         print("Final evaluation:")
-        final_eval_results = eval_model_acc(model, eval_ds, eval_batch_size)
+        final_eval_results = eval_model_acc(
+            model, eval_ds, eval_batch_size, mixed_precision=mixed_precision
+        )
         logger.logkv("eval_accuracy", np.mean([r["acc"] for r in final_eval_results]))
         logger.dumpkvs()
     
@@ -186,9 +296,16 @@ def train_and_save_model(
     optimizer_name: str = "adam",
     eval_every: Optional[int] = None,
     strong_ckpt_path: Optional[str] = None,
+    mixed_precision: str = "bf16",
+    quantize_backbone: str = "none",
 ):
     if eval_batch_size is None:
         eval_batch_size = batch_size
+    assert quantize_backbone in (
+        "none",
+        "bf16",
+        "int8",
+    ), f"invalid quantize_backbone {quantize_backbone}, must be none, bf16 or int8"
 
     if minibatch_size_per_device is None:
         minibatch_size_per_device = 1
@@ -201,15 +318,19 @@ def train_and_save_model(
         if os.path.exists(os.path.join(save_path, "results.txt")) and not force_retrain:
             print("loading from", save_path)
             checkpoint_path = os.path.join(save_path, "model.safetensors")
-            if not os.path.exists(checkpoint_path):
-                load_sharded_checkpoint(model, checkpoint_path)
-            else:
+            if os.path.exists(checkpoint_path):
+                # single-file safetensors: load_model mmaps the file instead of
+                # staging a full pickled state dict in CPU RAM
                 load_model(model, checkpoint_path)
+            else:
+                # sharded save: the index and shard files live in the directory
+                load_sharded_checkpoint(model, save_path)
             return True
         return False
 
-    already_trained = False
-    # Load the model
+    # Load the model. device_map="auto" already shards model-parallel configs
+    # across GPUs, so only the single-device path is moved wholesale — calling
+    # .to("cuda") on a sharded model would drag every shard back to GPU 0.
     if model_config.model_parallel:
         assert torch.cuda.device_count() > 1, f"you might want more gpus for {model_config.name}"
         model = TransformerWithHead.from_pretrained(
@@ -219,14 +340,8 @@ def train_and_save_model(
             linear_probe=linear_probe,
             **custom_kwargs,
         )
-        if strong_ckpt_path:
-            load_model(model, strong_ckpt_path)
-            print("Checkpoint loaded successfully!")
-
-        already_trained = maybe_load_model(model)
         # slight misnomer, more like minibatch_size_per_dp_replica
         minibatch_size = minibatch_size_per_device
-
     else:
         model = TransformerWithHead.from_pretrained(
             model_config.name,
@@ -234,29 +349,91 @@ def train_and_save_model(
             linear_probe=linear_probe,
             **custom_kwargs
         ).to("cuda")
-        if strong_ckpt_path:
-            load_model(model, strong_ckpt_path)
-            print("Checkpoint loaded successfully!")
+        if torch.cuda.device_count() > 1:
+            minibatch_size = min(minibatch_size_per_device * torch.cuda.device_count(), batch_size)
+        else:
+            minibatch_size = minibatch_size_per_device
 
-        already_trained = maybe_load_model(model)
-        # data parallel:  currently not supported with model parallel
+    if strong_ckpt_path:
+        load_model(model, strong_ckpt_path)
+        print("Checkpoint loaded successfully!")
 
-        minibatch_size = min(minibatch_size_per_device * torch.cuda.device_count(), batch_size)
+    already_trained = maybe_load_model(model)
 
-        if torch.cuda.device_count() > 1:
-            model = torch.nn.DataParallel(model, output_device=0)
-            print(
-                "Using",
-                torch.cuda.device_count(),
-                "GPUs, setting minibatch_size to",
-                minibatch_size,
+    # quantize after checkpoints are loaded (both loads expect full-precision
+    # tensors). This is meant for frozen-backbone runs: the matmuls are memory
+    # bound, so halving/quartering weight bytes buys roughly that much forward
+    # throughput, while the classification head stays fp32.
+    if quantize_backbone == "bf16":
+        model.transformer.to(torch.bfloat16)
+    elif quantize_backbone == "int8":
+        assert linear_probe, "int8 backbone weights are frozen, use linear_probe"
+        try:
+            import bitsandbytes as bnb
+        except ImportError as e:
+            raise ImportError("quantize_backbone='int8' requires bitsandbytes") from e
+
+        def swap_linear_int8(module):
+            swapped = 0
+            for name, child in module.named_children():
+                if isinstance(child, (torch.nn.Linear, Conv1D)):
+                    if isinstance(child, Conv1D):
+                        # gpt2's Conv1D keeps the weight as (in, out);
+                        # Linear8bitLt wants the Linear layout (out, in)
+                        weight = child.weight.data.t().contiguous()
+                    else:
+                        weight = child.weight.data.contiguous()
+                    out_features, in_features = weight.shape
+                    int8_lin = bnb.nn.Linear8bitLt(
+                        in_features,
+                        out_features,
+                        bias=child.bias is not None,
+                        has_fp16_weights=False,
+                    )
+                    # Int8Params only runs the int8 transform on a cpu->cuda
+                    # move, so stage the weight on cpu and let the .to() below
+                    # quantize it; handing it cuda data would skip quantization
+                    int8_lin.weight = bnb.nn.Int8Params(
+                        weight.cpu(), requires_grad=False, has_fp16_weights=False
+                    )
+                    if child.bias is not None:
+                        int8_lin.bias = child.bias
+                    int8_lin.to(child.weight.device)
+                    setattr(module, name, int8_lin)
+                    swapped += 1
+                else:
+                    swapped += swap_linear_int8(child)
+            return swapped
+
+        n_swapped = swap_linear_int8(model.transformer)
+        assert n_swapped > 0, "quantize_backbone='int8' found no linear layers to swap"
+        # smoke-test one quantized layer so a broken swap fails here, not mid-run
+        probe = next(
+            m for m in model.transformer.modules() if isinstance(m, bnb.nn.Linear8bitLt)
+        )
+        with torch.no_grad():
+            probe(
+                torch.zeros(
+                    1, probe.in_features, dtype=torch.float16, device=probe.weight.device
+                )
             )
-        else:
-            minibatch_size = minibatch_size_per_device
+        print(f"Quantized {n_swapped} backbone linear layers to int8")
+
+    # data parallel:  currently not supported with model parallel
+    if not model_config.model_parallel and torch.cuda.device_count() > 1:
+        model = torch.nn.DataParallel(model, output_device=0)
+        print(
+            "Using",
+            torch.cuda.device_count(),
+            "GPUs, setting minibatch_size to",
+            minibatch_size,
+        )
 
     print("Already trained: {}".format(already_trained))
     if already_trained:
-        test_results = eval_model_acc(model, test_ds, eval_batch_size)
+        test_results = eval_model_acc(
+            model, test_ds, eval_batch_size, mixed_precision=mixed_precision
+        )
     else:
         start = time.time()
         test_results = train_model(
@@ -274,6 +451,7 @@ def train_and_save_model(
             train_with_dropout=train_with_dropout,
             lr_schedule=lr_schedule,
             optimizer_name=optimizer_name,
+            mixed_precision=mixed_precision,
         )
         print("Model training took", time.time() - start, "seconds")
         if save_path:
@@ -285,7 +463,9 @@ def train_and_save_model(
 
     inference_results = None
     if inference_ds:
-        inference_results = eval_model_acc(model, inference_ds, eval_batch_size)
+        inference_results = eval_model_acc(
+            model, inference_ds, eval_batch_size, mixed_precision=mixed_precision
+        )
         logger.logkv("inference_accuracy", np.mean([r["acc"] for r in inference_results]))
 
     if save_path: